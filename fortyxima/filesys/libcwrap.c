@@ -1,10 +1,24 @@
+#ifdef __linux__
+#define _GNU_SOURCE
+#endif
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <dirent.h>
+#include <errno.h>
+#include <fcntl.h>
 #include <string.h>
+#include <time.h>
 #include <unistd.h>
+#ifdef __linux__
+#include <poll.h>
+#include <sys/inotify.h>
+#endif
+#ifdef WITH_PTHREAD
+#include <pthread.h>
+#endif
 
 /** Initial size for path names. */
 const size_t initsize = 1024;
@@ -13,10 +27,98 @@ const size_t initsize = 1024;
 const size_t maxsize = 16384;
 
 
+/** Instrumented operations. */
+enum stats_op {
+  STATS_STAT, STATS_MAKEDIR, STATS_RMTREE, STATS_COPYFILE, STATS_READDIR,
+  STATS_NOPS
+};
+
+/** Names of the instrumented operations (as used in the JSON output). */
+static const char *stats_opnames[STATS_NOPS] = {
+  "stat", "makeDir", "removeDir", "copyFile", "readDir"
+};
+
+/** Number of latency histogram buckets. */
+#define STATS_NBUCKETS 32
+
+/** Statistics of an operation. */
+struct fortyxima_filesys_stats {
+  /** Number of calls. */
+  long long calls;
+  /** Number of failed calls. */
+  long long errors;
+  /** Number of bytes copied. */
+  long long bytes;
+  /** Total time spent in the calls (ns). */
+  long long time;
+  /** Number of calls with latency in [2^i, 2^(i+1)) ns (first and last
+   *  bucket also contain shorter and longer ones, respectively). */
+  long long latency[STATS_NBUCKETS];
+};
+
+/** Whether statistics are collected. */
+static int stats_enabled = 0;
+
+/** Collected statistics. */
+static struct fortyxima_filesys_stats stats[STATS_NOPS];
+
+/** Name of the file the statistics are written to at exit. */
+static char *stats_fname = NULL;
+
+/** Starts the timing of an operation (sets t0 to 0 if disabled). */
+#define STATS_START(t0) ((t0) = stats_enabled ? stats_clock() : 0)
+
+/** Records the statistics of an operation started by STATS_START. */
+#define STATS_STOP(op, t0, failed, nbytes)		\
+  do {							\
+    if (t0) {						\
+      stats_record((op), (t0), (failed), (nbytes));	\
+    }							\
+  } while (0)
+
+
+/** Returns a monotonic time in ns. */
+static long long stats_clock(void)
+{
+  struct timespec ts;
+
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (long long) ts.tv_sec * 1000000000LL + ts.tv_nsec;
+}
+
+
+/** Adds a call to the statistics of an operation.
+ *  \param op  Operation.
+ *  \param t0  Start time of the call as returned by stats_clock().
+ *  \param failed  Whether the call failed.
+ *  \param nbytes  Number of bytes copied during the call.
+ */
+static void stats_record(int op, long long t0, int failed, long long nbytes)
+{
+  long long elapsed;
+  int bucket;
+
+  elapsed = stats_clock() - t0;
+  for (bucket = 0; bucket < STATS_NBUCKETS - 1 && (elapsed >> (bucket + 1));
+       bucket++) ;
+  __sync_fetch_and_add(&stats[op].calls, 1);
+  __sync_fetch_and_add(&stats[op].time, elapsed);
+  __sync_fetch_and_add(&stats[op].latency[bucket], 1);
+  if (failed) {
+    __sync_fetch_and_add(&stats[op].errors, 1);
+  }
+  if (nbytes) {
+    __sync_fetch_and_add(&stats[op].bytes, nbytes);
+  }
+}
+
+
 /** Delivers the file name of the next entry within a directory.
  *
  *  \details Delivers a string to the next entry within a directory. The
- *  entries '.' and '..' are filtered out.
+ *  entries '.' and '..' are filtered out. It is safe to call the routine
+ *  from different threads at the same time, provided they use different
+ *  directory descriptors.
  *
  *  \param dp  Directory descriptor.
  *  \return Pointer to the name of the next entry or NULL if any error occured.
@@ -24,30 +126,26 @@ const size_t maxsize = 16384;
  */
 char *fortyxima_filesys_nextdirentry_name(DIR *dp)
 {
-  struct dirent dent;
-  struct dirent *result;
+  struct dirent *ep;
   char *buffer;
-  int status;
+  long long t0;
 
+  STATS_START(t0);
+  buffer = NULL;
+  errno = 0;
   if (dp != NULL) {
-    while (1) {
-      status = readdir_r(dp, &dent, &result);
-      if (status || result != &dent) {
-	break;
-      }
-      if (strcmp(dent.d_name, ".") && strcmp(dent.d_name, "..")) {
-	buffer = (char *) malloc(sizeof(char) * (strlen(dent.d_name) + 1));
+    while ((ep = readdir(dp))) {
+      if (strcmp(ep->d_name, ".") && strcmp(ep->d_name, "..")) {
+	buffer = (char *) malloc(sizeof(char) * (strlen(ep->d_name) + 1));
 	if (buffer != NULL) {
-	  strcpy(buffer, dent.d_name);
-	  return buffer;
-	}
-	else {
-	  break;
+	  strcpy(buffer, ep->d_name);
 	}
+	break;
       }
     }
   }
-  return NULL;
+  STATS_STOP(STATS_READDIR, t0, buffer == NULL && errno, 0);
+  return buffer;
 }
 
 
@@ -66,15 +164,115 @@ char *fortyxima_filesys_direntry_name(struct dirent *direntry)
 }  
 
 
-/** Decides whether a given file name is a directory.
+/** Opens a directory and returns a file descriptor for it.
+ *  \param parentfd  Descriptor of the directory relative paths are
+ *      interpreted to (negative value: current working directory).
+ *  \param dirname  Name of the directory.
+ *  \param fd  File descriptor on return (-1 on failure).
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_opendirfd(int parentfd, const char *dirname, int *fd)
+{
+  if (parentfd < 0) {
+    parentfd = AT_FDCWD;
+  }
+  *fd = openat(parentfd, dirname, O_RDONLY | O_DIRECTORY | O_CLOEXEC);
+  return (*fd < 0) ? errno : 0;
+}
+
+
+/** Closes a file descriptor.
+ *  \param fd  File descriptor.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_closefd(int fd)
+{
+  return close(fd) ? errno : 0;
+}
+
+
+/** Opens a directory stream for a directory relative to a descriptor.
+ *  \param dirfd  Descriptor of the directory dirname is relative to.
+ *  \param dirname  Name of the directory to open.
+ *  \param error  0 on success, errno value otherwise.
+ *  \return  Directory stream or NULL if any error occured.
+ */
+DIR *fortyxima_filesys_opendirat(int dirfd, const char *dirname, int *error)
+{
+  DIR *dp;
+  int fd;
+
+  *error = fortyxima_filesys_opendirfd(dirfd, dirname, &fd);
+  if (*error) {
+    return NULL;
+  }
+  dp = fdopendir(fd);
+  if (dp == NULL) {
+    *error = errno;
+    close(fd);
+  }
+  return dp;
+}
+
+
+/** Creates a directory relative to a descriptor.
+ *  \param dirfd  Descriptor of the directory dirname is relative to.
+ *  \param dirname  Name of the directory.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_makedirat(int dirfd, const char *dirname)
+{
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = mkdirat(dirfd, dirname, S_IRWXU | S_IRWXG | S_IRWXO) ? errno : 0;
+  STATS_STOP(STATS_MAKEDIR, t0, status, 0);
+  return status;
+}
+
+
+/** Removes a file or an empty directory relative to a descriptor.
+ *  \param dirfd  Descriptor of the directory fname is relative to.
+ *  \param fname  Name of the file.
+ *  \param isdir  Whether fname is a directory.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_unlinkat(int dirfd, const char *fname, int isdir)
+{
+  return unlinkat(dirfd, fname, isdir ? AT_REMOVEDIR : 0) ? errno : 0;
+}
+
+
+/** Renames a file relative to descriptors.
+ *  \param olddirfd  Descriptor of the directory oldname is relative to.
+ *  \param oldname  Old name of the file.
+ *  \param newdirfd  Descriptor of the directory newname is relative to.
+ *  \param newname  New name of the file.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_renameat(int olddirfd, const char *oldname, 
+			       int newdirfd, const char *newname)
+{
+  return renameat(olddirfd, oldname, newdirfd, newname) ? errno : 0;
+}
+
+
+/** Decides whether a file relative to a descriptor is a directory.
+ *  \param dirfd  Descriptor of the directory fname is relative to.
  *  \param fname  File name.
  *  \return 1 if file exists and is a directory, 0 otherwise.
  */
-int fortyxima_filesys_isdir(const char *fname)
+int fortyxima_filesys_isdirat(int dirfd, const char *fname)
 {
   struct stat statbuf;
-  
-  if (stat(fname, &statbuf)) {
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = fstatat(dirfd, fname, &statbuf, 0);
+  STATS_STOP(STATS_STAT, t0, status, 0);
+  if (status) {
     return 0;
   }
   else {
@@ -83,15 +281,21 @@ int fortyxima_filesys_isdir(const char *fname)
 }
 
 
-/** Decides whether a given file name is a symbolic link.
+/** Decides whether a file relative to a descriptor is a symbolic link.
+ *  \param dirfd  Descriptor of the directory fname is relative to.
  *  \param fname  File name.
  *  \return 1 if file exists and is a symlink, 0 otherwise.
  */
-int fortyxima_filesys_islink(const char *fname)
+int fortyxima_filesys_islinkat(int dirfd, const char *fname)
 {
   struct stat statbuf;
-  
-  if (lstat(fname, &statbuf)) {
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = fstatat(dirfd, fname, &statbuf, AT_SYMLINK_NOFOLLOW);
+  STATS_STOP(STATS_STAT, t0, status, 0);
+  if (status) {
     return 0;
   }
   else {
@@ -100,31 +304,42 @@ int fortyxima_filesys_islink(const char *fname)
 }
 
 
-/** Checks, whether a given file exists.
+/** Checks, whether a file relative to a descriptor exists.
+ *  \param dirfd  Descriptor of the directory fname is relative to.
  *  \param fname  File name.
  *  \return 1 if file exists, 0 otherwise.
  */
-int fortyxima_filesys_file_exists(const char *fname)
+int fortyxima_filesys_file_existsat(int dirfd, const char *fname)
 {
   struct stat statbuf;
+  long long t0;
+  int status;
 
-  return !stat(fname, &statbuf);
+  STATS_START(t0);
+  status = fstatat(dirfd, fname, &statbuf, 0);
+  STATS_STOP(STATS_STAT, t0, status, 0);
+  return !status;
 }
 
 
-/** Returns the size of a file.
+/** Returns the size of a file relative to a descriptor.
+ *  \param dirfd  Descriptor of the directory fname is relative to.
  *  \param fname  File name.
  *  \return  Size of the file converted to size_t. If the file status can't
  *      be determined, the return value is -1. If the file size can't be
  *      converted to size_t, -2 is returned.
- *  
  */
-size_t fortyxima_filesys_filesize(const char *fname)
+size_t fortyxima_filesys_filesizeat(int dirfd, const char *fname)
 {
   struct stat statbuf;
   size_t fsize;
-  
-  if (stat(fname, &statbuf)) {
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = fstatat(dirfd, fname, &statbuf, 0);
+  STATS_STOP(STATS_STAT, t0, status, 0);
+  if (status) {
     return -1;
   }
   fsize = (size_t) statbuf.st_size;
@@ -137,13 +352,62 @@ size_t fortyxima_filesys_filesize(const char *fname)
 }
 
 
+/** Decides whether a given file name is a directory.
+ *  \param fname  File name.
+ *  \return 1 if file exists and is a directory, 0 otherwise.
+ */
+int fortyxima_filesys_isdir(const char *fname)
+{
+  return fortyxima_filesys_isdirat(AT_FDCWD, fname);
+}
+
+
+/** Decides whether a given file name is a symbolic link.
+ *  \param fname  File name.
+ *  \return 1 if file exists and is a symlink, 0 otherwise.
+ */
+int fortyxima_filesys_islink(const char *fname)
+{
+  return fortyxima_filesys_islinkat(AT_FDCWD, fname);
+}
+
+
+/** Checks, whether a given file exists.
+ *  \param fname  File name.
+ *  \return 1 if file exists, 0 otherwise.
+ */
+int fortyxima_filesys_file_exists(const char *fname)
+{
+  return fortyxima_filesys_file_existsat(AT_FDCWD, fname);
+}
+
+
+/** Returns the size of a file.
+ *  \param fname  File name.
+ *  \return  Size of the file converted to size_t. If the file status can't
+ *      be determined, the return value is -1. If the file size can't be
+ *      converted to size_t, -2 is returned.
+ *  
+ */
+size_t fortyxima_filesys_filesize(const char *fname)
+{
+  return fortyxima_filesys_filesizeat(AT_FDCWD, fname);
+}
+
+
 /** Creates a directory with all possible permitions (except those in umask).
  *  \param dirname  Name of the directory.
  *  \return Status code of the mkdir system call.
  */
 int fortyxima_filesys_makedir(const char *dirname)
 {
-  return mkdir(dirname, S_IRWXU | S_IRWXG | S_IRWXO);
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = mkdir(dirname, S_IRWXU | S_IRWXG | S_IRWXO);
+  STATS_STOP(STATS_MAKEDIR, t0, status, 0);
+  return status;
 }
 
 
@@ -178,7 +442,7 @@ int _fortyxima_filesys_makedir_parent(const char *dirname, int dnamelen)
   }
   /* File still does not exist yet */
   if (status) {
-    return fortyxima_filesys_makedir(dirname);
+    return mkdir(dirname, S_IRWXU | S_IRWXG | S_IRWXO);
   }
   /* File exists and is a directory. */
   else if (S_ISDIR(statbuf.st_mode)) {
@@ -200,7 +464,9 @@ int fortyxima_filesys_makedir_parent(const char *dirname)
   int dnamelen;
   char *newdirname;
   int status;
+  long long t0;
 
+  STATS_START(t0);
   dnamelen = strlen(dirname);
   if (dirname[dnamelen-1] == '/') {
     newdirname = (char *) malloc(sizeof(char) * dnamelen);
@@ -213,15 +479,13 @@ int fortyxima_filesys_makedir_parent(const char *dirname)
   else {
     status = _fortyxima_filesys_makedir_parent(dirname, dnamelen);
   }
+  STATS_STOP(STATS_MAKEDIR, t0, status, 0);
   return status;
 }
 
 
-/** Recursively deletes an entry in the file system.
- * \param fname  File name.
- * \return 0 if recursive delete was successful, or some error codes otherwise.
- */
-int fortyxima_filesys_rmtree(const char *fname)
+/** Helper routine for fortyxima_filesys_rmtree. */
+int _fortyxima_filesys_rmtree(const char *fname)
 {
   DIR *dp;
   struct dirent *ep;
@@ -245,7 +509,7 @@ int fortyxima_filesys_rmtree(const char *fname)
 	strcpy(newfname, fname);
 	strcat(newfname, "/");
 	strcat(newfname, ep->d_name);
-	status = fortyxima_filesys_rmtree(newfname);
+	status = _fortyxima_filesys_rmtree(newfname);
 	free(newfname);
 	if (status) {
 	  return status;
@@ -266,6 +530,22 @@ int fortyxima_filesys_rmtree(const char *fname)
 }
 
 
+/** Recursively deletes an entry in the file system.
+ * \param fname  File name.
+ * \return 0 if recursive delete was successful, or some error codes otherwise.
+ */
+int fortyxima_filesys_rmtree(const char *fname)
+{
+  long long t0;
+  int status;
+
+  STATS_START(t0);
+  status = _fortyxima_filesys_rmtree(fname);
+  STATS_STOP(STATS_RMTREE, t0, status, 0);
+  return status;
+}
+
+
 /** Returning working directory name with dynamic allocation as in glibc.
  *  \return Name of the working directory or NULL if any error happened. String
  *      should be deallocated by the caller.
@@ -371,10 +651,14 @@ int fortyxima_copyfile(const char *orig, const char *copy, int buffsize)
   FILE *porig, *pcopy;
   int status;
   size_t nn;
+  long long t0, nbytes;
 
+  STATS_START(t0);
+  nbytes = 0;
   porig = fopen(orig, "rb");
   pcopy = fopen(copy, "wb");
   if (porig == NULL || pcopy == NULL) {
+    STATS_STOP(STATS_COPYFILE, t0, 1, 0);
     return -1;
   }
   status = 0;
@@ -383,8 +667,1334 @@ int fortyxima_copyfile(const char *orig, const char *copy, int buffsize)
       status = -2;
       break;
     }
+    nbytes += nn;
   }
   fclose(porig);
   fclose(pcopy);
+  STATS_STOP(STATS_COPYFILE, t0, status, nbytes);
+  return status;
+}
+
+
+/** Counter making names of temporary files unique within the process. */
+static unsigned int tmpcounter = 0;
+
+
+/** Writes data to a file descriptor (continuing after partial writes).
+ *  \return 0 on success, errno value otherwise.
+ */
+static int write_all(int fd, const char *data, size_t len)
+{
+  ssize_t nn;
+
+  while (len > 0) {
+    nn = write(fd, data, len);
+    if (nn < 0) {
+      if (errno == EINTR) {
+	continue;
+      }
+      return errno;
+    }
+    data += nn;
+    len -= (size_t) nn;
+  }
+  return 0;
+}
+
+
+/** Flushes a file or directory to the storage device.
+ *  \param fname  Name of the file or directory.
+ *  \return 0 on success, errno value otherwise.
+ */
+static int sync_file(const char *fname)
+{
+  int fd, status;
+
+  fd = open(fname, O_RDONLY | O_CLOEXEC);
+  if (fd < 0) {
+    return errno;
+  }
+  status = fsync(fd) ? errno : 0;
+  close(fd);
+  return status;
+}
+
+
+/** Returns the name of the directory containing a file.
+ *  \param fname  File name.
+ *  \return Name of the parent directory or NULL if allocation failed. It
+ *      should be deallocated by the caller.
+ */
+static char *parent_dir(const char *fname)
+{
+  const char *slash;
+  char *dirname;
+  size_t len;
+
+  slash = strrchr(fname, '/');
+  if (slash == NULL) {
+    return fortyxima_filesys_copystring(".");
+  }
+  len = (slash == fname) ? 1 : (size_t) (slash - fname);
+  dirname = (char *) malloc(sizeof(char) * (len + 1));
+  if (dirname != NULL) {
+    strncpy(dirname, fname, len);
+    dirname[len] = '\0';
+  }
+  return dirname;
+}
+
+
+static int compare_strings(const void *p1, const void *p2)
+{
+  return strcmp(*(char * const *) p1, *(char * const *) p2);
+}
+
+
+/** Flushes the directories containing given files (each directory once).
+ *  \param nfiles  Number of files.
+ *  \param fnames  Names of the files.
+ *  \return 0 on success, errno value of the first failing call otherwise.
+ */
+static int sync_parent_dirs(int nfiles, const char **fnames)
+{
+  char **dirnames;
+  int ii, status;
+
+  dirnames = (char **) calloc(nfiles, sizeof(char *));
+  if (dirnames == NULL) {
+    return ENOMEM;
+  }
+  status = 0;
+  for (ii = 0; ii < nfiles; ii++) {
+    dirnames[ii] = parent_dir(fnames[ii]);
+    if (dirnames[ii] == NULL) {
+      status = ENOMEM;
+    }
+  }
+  if (!status) {
+    qsort(dirnames, nfiles, sizeof(char *), compare_strings);
+    for (ii = 0; ii < nfiles && !status; ii++) {
+      if (ii == 0 || strcmp(dirnames[ii], dirnames[ii - 1])) {
+	status = sync_file(dirnames[ii]);
+      }
+    }
+  }
+  for (ii = 0; ii < nfiles; ii++) {
+    free(dirnames[ii]);
+  }
+  free(dirnames);
+  return status;
+}
+
+
+/** Replaces the content of a file atomically and durably.
+ *
+ *  \details The data is written into a temporary file in the same directory,
+ *  which is flushed to the device and then renamed to the target. Finally,
+ *  the directory containing the file is flushed. After a crash the file
+ *  contains either its old or its new content. If the file already exists,
+ *  its permissions are kept.
+ *
+ *  \param fname  Name of the file.
+ *  \param data  Data to write.
+ *  \param len  Number of bytes to write.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_writeatomic(const char *fname, const char *data,
+				  size_t len)
+{
+  char *tmpname;
+  int fd, status;
+  struct stat statbuf;
+
+  tmpname = (char *) malloc(sizeof(char) * (strlen(fname) + 64));
+  if (tmpname == NULL) {
+    return ENOMEM;
+  }
+  sprintf(tmpname, "%s.tmp%ld.%u", fname, (long) getpid(),
+	  __sync_fetch_and_add(&tmpcounter, 1));
+  fd = open(tmpname, O_WRONLY | O_CREAT | O_EXCL | O_CLOEXEC,
+	    S_IRUSR | S_IWUSR | S_IRGRP | S_IWGRP | S_IROTH | S_IWOTH);
+  if (fd < 0) {
+    status = errno;
+    free(tmpname);
+    return status;
+  }
+  status = write_all(fd, data, len);
+  if (!status && !stat(fname, &statbuf)
+      && fchmod(fd, statbuf.st_mode & 07777)) {
+    status = errno;
+  }
+  if (!status && fsync(fd)) {
+    status = errno;
+  }
+  if (close(fd) && !status) {
+    status = errno;
+  }
+  if (!status && rename(tmpname, fname)) {
+    status = errno;
+  }
+  if (status) {
+    unlink(tmpname);
+  }
+  else {
+    status = sync_parent_dirs(1, &fname);
+  }
+  free(tmpname);
+  return status;
+}
+
+
+/** Splits a sequence of 0-terminated strings into an array of strings.
+ *  \return Array of pointers into strings or NULL if allocation failed. It
+ *      should be deallocated by the caller (but not the strings themselves).
+ */
+static const char **split_strings(int nstrings, const char *strings)
+{
+  const char **array;
+  int ii;
+
+  array = (const char **) malloc(sizeof(char *) * (nstrings + 1));
+  if (array != NULL) {
+    for (ii = 0; ii < nstrings; ii++) {
+      array[ii] = strings;
+      strings += strlen(strings) + 1;
+    }
+  }
+  return array;
+}
+
+
+/** Flushes files to the device, renames them and flushes their directories.
+ *
+ *  \details All temporary files are flushed first (either one by one or by
+ *  one syncfs call per file system), then they are renamed to their final
+ *  names, and finally each directory containing a final file is flushed
+ *  once. Stops at the first error, already renamed files stay in place.
+ *
+ *  \param nfiles  Number of files.
+ *  \param tmpnames  Names of the temporary files (nfiles 0-terminated strings
+ *      following each other).
+ *  \param fnames  Final names of the files (same format as tmpnames).
+ *  \param usesyncfs  Whether syncfs should be used instead of fsync calls.
+ *  \return 0 on success, errno value of the first failing call otherwise.
+ */
+int fortyxima_filesys_commitfiles(int nfiles, const char *tmpnames,
+				  const char *fnames, int usesyncfs)
+{
+  const char **tmparray, **farray;
+  int ii, status;
+
+  if (nfiles <= 0) {
+    return 0;
+  }
+  tmparray = split_strings(nfiles, tmpnames);
+  farray = split_strings(nfiles, fnames);
+  status = (tmparray == NULL || farray == NULL) ? ENOMEM : 0;
+#ifdef __linux__
+  if (!status && usesyncfs) {
+    struct stat statbuf;
+    dev_t *devs;
+    int ndevs, jj, fd;
+
+    devs = (dev_t *) malloc(sizeof(dev_t) * nfiles);
+    ndevs = 0;
+    status = (devs == NULL) ? ENOMEM : 0;
+    for (ii = 0; ii < nfiles && !status; ii++) {
+      if (stat(tmparray[ii], &statbuf)) {
+	status = errno;
+	break;
+      }
+      for (jj = 0; jj < ndevs && devs[jj] != statbuf.st_dev; jj++) ;
+      if (jj < ndevs) {
+	continue;
+      }
+      devs[ndevs++] = statbuf.st_dev;
+      fd = open(tmparray[ii], O_RDONLY | O_CLOEXEC);
+      if (fd < 0) {
+	status = errno;
+      }
+      else {
+	status = syncfs(fd) ? errno : 0;
+	close(fd);
+      }
+    }
+    free(devs);
+  }
+  else
+#endif
+  {
+    for (ii = 0; ii < nfiles && !status; ii++) {
+      status = sync_file(tmparray[ii]);
+    }
+  }
+  for (ii = 0; ii < nfiles && !status; ii++) {
+    status = rename(tmparray[ii], farray[ii]) ? errno : 0;
+  }
+  if (!status) {
+    status = sync_parent_dirs(nfiles, farray);
+  }
+  free(tmparray);
+  free(farray);
   return status;
 }
+
+
+/** Size of the buffer for the events of a file watcher. */
+#define WATCHER_BUFFSIZE 65536
+
+/** Watches files and directories for changes (using inotify). */
+struct fortyxima_filesys_watcher {
+  /** Inotify file descriptor. */
+  int fd;
+  /** Number of active watches. */
+  int nwatches;
+  /** Size of the wds and paths arrays. */
+  int maxwatches;
+  /** Watch descriptors. */
+  int *wds;
+  /** Watched paths belonging to the watch descriptors. */
+  char **paths;
+  /** Number of valid bytes in the event buffer. */
+  size_t buflen;
+  /** Position of the next unprocessed event in the event buffer. */
+  size_t bufpos;
+  /** Buffer for the events read from the file descriptor. */
+  char *buffer;
+};
+
+typedef struct fortyxima_filesys_watcher watcher_t;
+
+
+/** Creates a file watcher.
+ *  \param error  0 on success, errno value otherwise.
+ *  \return Pointer to the watcher or NULL if it could not be created. It must
+ *      be destroyed with fortyxima_filesys_watcher_destroy().
+ */
+watcher_t *fortyxima_filesys_watcher_create(int *error)
+{
+#ifdef __linux__
+  watcher_t *watcher;
+
+  watcher = (watcher_t *) calloc(1, sizeof(watcher_t));
+  if (watcher == NULL) {
+    *error = ENOMEM;
+    return NULL;
+  }
+  watcher->buffer = (char *) malloc(WATCHER_BUFFSIZE);
+  if (watcher->buffer == NULL) {
+    free(watcher);
+    *error = ENOMEM;
+    return NULL;
+  }
+  watcher->fd = inotify_init1(IN_NONBLOCK | IN_CLOEXEC);
+  if (watcher->fd < 0) {
+    *error = errno;
+    free(watcher->buffer);
+    free(watcher);
+    return NULL;
+  }
+  *error = 0;
+  return watcher;
+#else
+  *error = ENOSYS;
+  return NULL;
+#endif
+}
+
+
+/** Destroys a file watcher.
+ *  \param watcher  Watcher to destroy (may be NULL).
+ */
+void fortyxima_filesys_watcher_destroy(watcher_t *watcher)
+{
+  int ii;
+
+  if (watcher == NULL) {
+    return;
+  }
+  close(watcher->fd);
+  for (ii = 0; ii < watcher->nwatches; ii++) {
+    free(watcher->paths[ii]);
+  }
+  free(watcher->wds);
+  free(watcher->paths);
+  free(watcher->buffer);
+  free(watcher);
+}
+
+
+/** Starts watching a file or a directory.
+ *  \param watcher  File watcher.
+ *  \param path  Path to watch.
+ *  \param mask  Events to watch for (inotify event mask). If the path is
+ *      already watched, the previous mask is replaced.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_watcher_add(watcher_t *watcher, const char *path,
+				  int mask)
+{
+#ifdef __linux__
+  char *pathcopy;
+  int wd, ii, newmax;
+  int *wds;
+  char **paths;
+
+  if (watcher == NULL) {
+    return EINVAL;
+  }
+  wd = inotify_add_watch(watcher->fd, path, (uint32_t) mask);
+  if (wd < 0) {
+    return errno;
+  }
+  pathcopy = fortyxima_filesys_copystring(path);
+  if (pathcopy == NULL) {
+    inotify_rm_watch(watcher->fd, wd);
+    return ENOMEM;
+  }
+  for (ii = 0; ii < watcher->nwatches && watcher->wds[ii] != wd; ii++) ;
+  if (ii == watcher->nwatches) {
+    if (ii == watcher->maxwatches) {
+      newmax = 2 * watcher->maxwatches + 8;
+      wds = (int *) realloc(watcher->wds, sizeof(int) * newmax);
+      if (wds != NULL) {
+	watcher->wds = wds;
+      }
+      paths = (char **) realloc(watcher->paths, sizeof(char *) * newmax);
+      if (paths != NULL) {
+	watcher->paths = paths;
+      }
+      if (wds == NULL || paths == NULL) {
+	inotify_rm_watch(watcher->fd, wd);
+	free(pathcopy);
+	return ENOMEM;
+      }
+      watcher->maxwatches = newmax;
+    }
+    watcher->nwatches++;
+  }
+  else {
+    free(watcher->paths[ii]);
+  }
+  watcher->wds[ii] = wd;
+  watcher->paths[ii] = pathcopy;
+  return 0;
+#else
+  return ENOSYS;
+#endif
+}
+
+
+/** Waits for events and reads them into the event buffer of the watcher.
+ *
+ *  \details Events not processed by fortyxima_filesys_watcher_next() since
+ *  the last call are discarded. Events not fitting into the buffer are kept
+ *  by the kernel and delivered by the next call.
+ *
+ *  \param watcher  File watcher.
+ *  \param timeout  Maximal time to wait in milliseconds (0: return
+ *      immediately, negative: wait without limit).
+ *  \return 0 on success (also if no events arrived in time), errno value
+ *      otherwise.
+ */
+int fortyxima_filesys_watcher_wait(watcher_t *watcher, int timeout)
+{
+#ifdef __linux__
+  struct pollfd pfd;
+  ssize_t nn;
+  int status;
+
+  if (watcher == NULL) {
+    return EINVAL;
+  }
+  watcher->buflen = 0;
+  watcher->bufpos = 0;
+  pfd.fd = watcher->fd;
+  pfd.events = POLLIN;
+  do {
+    status = poll(&pfd, 1, timeout);
+  } while (status < 0 && errno == EINTR);
+  if (status < 0) {
+    return errno;
+  }
+  if (status == 0) {
+    return 0;
+  }
+  nn = read(watcher->fd, watcher->buffer, WATCHER_BUFFSIZE);
+  if (nn < 0) {
+    return (errno == EAGAIN || errno == EINTR) ? 0 : errno;
+  }
+  watcher->buflen = (size_t) nn;
+  return 0;
+#else
+  return ENOSYS;
+#endif
+}
+
+
+/** Delivers the next event from the event buffer of the watcher.
+ *
+ *  \param watcher  File watcher.
+ *  \param path  Watched path the event belongs to on return (NULL for queue
+ *      overflow events). It is owned by the watcher and only valid until the
+ *      next call.
+ *  \param name  Name of the affected file within the watched directory (empty
+ *      if the watched path itself is affected). Owned by the watcher.
+ *  \param mask  Event mask on return.
+ *  \return 1 if an event was delivered, 0 if there are no more events.
+ */
+int fortyxima_filesys_watcher_next(watcher_t *watcher, char **path,
+				   char **name, int *mask)
+{
+#ifdef __linux__
+  struct inotify_event *event;
+  int ii;
+
+  while (watcher != NULL && watcher->bufpos < watcher->buflen) {
+    event = (struct inotify_event *) (watcher->buffer + watcher->bufpos);
+    watcher->bufpos += sizeof(struct inotify_event) + event->len;
+    for (ii = 0; ii < watcher->nwatches && watcher->wds[ii] != event->wd;
+	 ii++) ;
+    if (event->mask & IN_IGNORED) {
+      /* Watch has been removed (e.g. watched file deleted) */
+      if (ii < watcher->nwatches) {
+	free(watcher->paths[ii]);
+	watcher->nwatches--;
+	watcher->wds[ii] = watcher->wds[watcher->nwatches];
+	watcher->paths[ii] = watcher->paths[watcher->nwatches];
+      }
+      continue;
+    }
+    *path = (ii < watcher->nwatches) ? watcher->paths[ii] : NULL;
+    *name = event->len ? event->name : "";
+    *mask = (int) event->mask;
+    return 1;
+  }
+#endif
+  return 0;
+}
+
+
+/** Number of threads loading files in the background. */
+#define PREFETCH_NTHREADS 4
+
+/** Size of the buffer used when reading files to load them into the cache. */
+#define PREFETCH_BUFFSIZE (256 * 1024)
+
+
+/** Loads a file into the page cache of the kernel.
+ *
+ *  \details Uses readahead() where available and falls back to reading
+ *  the file, if the file system does not support it.
+ *
+ *  \param fname  Name of the file.
+ */
+static void load_file(const char *fname)
+{
+  struct stat statbuf;
+  char *buffer;
+  off_t offset;
+  ssize_t nn;
+  int fd;
+
+  fd = open(fname, O_RDONLY | O_CLOEXEC);
+  if (fd < 0) {
+    return;
+  }
+#ifdef __linux__
+  if (!fstat(fd, &statbuf) && !readahead(fd, 0, (size_t) statbuf.st_size)) {
+    close(fd);
+    return;
+  }
+#endif
+  buffer = (char *) malloc(PREFETCH_BUFFSIZE);
+  if (buffer != NULL) {
+    offset = 0;
+    while ((nn = pread(fd, buffer, PREFETCH_BUFFSIZE, offset)) > 0
+	   || (nn < 0 && errno == EINTR)) {
+      offset += (nn > 0) ? nn : 0;
+    }
+    free(buffer);
+  }
+  close(fd);
+}
+
+
+#ifdef WITH_PTHREAD
+
+/** File waiting to be loaded by the background threads. */
+struct prefetch_job {
+  struct prefetch_job *next;
+  char *fname;
+};
+
+static pthread_mutex_t prefetch_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t prefetch_newjob = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t prefetch_alldone = PTHREAD_COND_INITIALIZER;
+static struct prefetch_job *prefetch_first = NULL, *prefetch_last = NULL;
+/** Number of queued or currently processed jobs. */
+static int prefetch_pending = 0;
+/** Number of started background threads. */
+static int prefetch_nthreads = 0;
+
+
+/** Main routine of the background threads. */
+static void *prefetch_worker(void *arg)
+{
+  struct prefetch_job *job;
+
+  for (;;) {
+    pthread_mutex_lock(&prefetch_mutex);
+    while (prefetch_first == NULL) {
+      pthread_cond_wait(&prefetch_newjob, &prefetch_mutex);
+    }
+    job = prefetch_first;
+    prefetch_first = job->next;
+    if (prefetch_first == NULL) {
+      prefetch_last = NULL;
+    }
+    pthread_mutex_unlock(&prefetch_mutex);
+
+    load_file(job->fname);
+    free(job->fname);
+    free(job);
+
+    pthread_mutex_lock(&prefetch_mutex);
+    prefetch_pending--;
+    if (prefetch_pending == 0) {
+      pthread_cond_broadcast(&prefetch_alldone);
+    }
+    pthread_mutex_unlock(&prefetch_mutex);
+  }
+  return arg;
+}
+
+
+/** Queues a file for being loaded by the background threads.
+ *  \param fname  Name of the file.
+ *  \return 1 if the file had been queued, 0 otherwise.
+ */
+static int queue_file(const char *fname)
+{
+  struct prefetch_job *job;
+  pthread_t thread;
+
+  job = (struct prefetch_job *) malloc(sizeof(struct prefetch_job));
+  if (job == NULL) {
+    return 0;
+  }
+  job->next = NULL;
+  job->fname = fortyxima_filesys_copystring(fname);
+  if (job->fname == NULL) {
+    free(job);
+    return 0;
+  }
+  pthread_mutex_lock(&prefetch_mutex);
+  while (prefetch_nthreads < PREFETCH_NTHREADS
+	 && !pthread_create(&thread, NULL, prefetch_worker, NULL)) {
+    pthread_detach(thread);
+    prefetch_nthreads++;
+  }
+  if (prefetch_nthreads == 0) {
+    pthread_mutex_unlock(&prefetch_mutex);
+    free(job->fname);
+    free(job);
+    return 0;
+  }
+  if (prefetch_last == NULL) {
+    prefetch_first = job;
+  }
+  else {
+    prefetch_last->next = job;
+  }
+  prefetch_last = job;
+  prefetch_pending++;
+  pthread_cond_signal(&prefetch_newjob);
+  pthread_mutex_unlock(&prefetch_mutex);
+  return 1;
+}
+
+#endif
+
+
+/** Announces that files will be read soon.
+ *
+ *  \details Passes the POSIX_FADV_WILLNEED hint to the kernel for each file.
+ *  If requested, the files are additionally loaded into the page cache by
+ *  background threads, which also works on file systems ignoring the hint.
+ *  (If background threads are not available, the files are loaded before
+ *  the routine returns.)
+ *
+ *  \param nfiles  Number of files.
+ *  \param fnames  Names of the files (nfiles 0-terminated strings following
+ *      each other).
+ *  \param background  Whether files should be loaded in the background.
+ *  \return 0 on success, errno value of the first file, which could not be
+ *      opened, otherwise. (The remaining files are processed nevertheless.)
+ */
+int fortyxima_filesys_prefetch(int nfiles, const char *fnames, int background)
+{
+  int ii, fd, status;
+
+  status = 0;
+  for (ii = 0; ii < nfiles; ii++, fnames += strlen(fnames) + 1) {
+    fd = open(fnames, O_RDONLY | O_CLOEXEC);
+    if (fd < 0) {
+      if (!status) {
+	status = errno;
+      }
+      continue;
+    }
+#ifdef POSIX_FADV_WILLNEED
+    posix_fadvise(fd, 0, 0, POSIX_FADV_WILLNEED);
+#endif
+    close(fd);
+    if (background) {
+#ifdef WITH_PTHREAD
+      if (queue_file(fnames)) {
+	continue;
+      }
+#endif
+      load_file(fnames);
+    }
+  }
+  return status;
+}
+
+
+/** Waits until the background threads loaded all queued files. */
+void fortyxima_filesys_waitprefetch()
+{
+#ifdef WITH_PTHREAD
+  pthread_mutex_lock(&prefetch_mutex);
+  while (prefetch_pending > 0) {
+    pthread_cond_wait(&prefetch_alldone, &prefetch_mutex);
+  }
+  pthread_mutex_unlock(&prefetch_mutex);
+#endif
+}
+
+
+/** Removes the content of a file from the page cache of the kernel.
+ *
+ *  \details Pending changes of the file are written to the device first, so
+ *  that all cached pages of the file can be dropped.
+ *
+ *  \param fname  Name of the file.
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_dropcache(const char *fname)
+{
+  int fd, status;
+
+  fd = open(fname, O_RDONLY | O_CLOEXEC);
+  if (fd < 0) {
+    return errno;
+  }
+  status = fdatasync(fd) ? errno : 0;
+#ifdef POSIX_FADV_DONTNEED
+  if (!status) {
+    status = posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED);
+  }
+#endif
+  close(fd);
+  return status;
+}
+
+
+/** Switches the collection of statistics on or off.
+ *  \param enabled  Whether statistics should be collected.
+ */
+void fortyxima_filesys_stats_enable(int enabled)
+{
+  stats_enabled = enabled;
+}
+
+
+/** Sets all collected statistics to zero. */
+void fortyxima_filesys_stats_reset()
+{
+  memset(stats, 0, sizeof(stats));
+}
+
+
+/** Returns the statistics of an operation.
+ *  \param op  Operation (0 <= op < STATS_NOPS).
+ *  \param opstats  Statistics on return.
+ *  \return 0 on success, EINVAL if the operation is invalid.
+ */
+int fortyxima_filesys_stats_get(int op, struct fortyxima_filesys_stats *opstats)
+{
+  if (op < 0 || op >= STATS_NOPS) {
+    return EINVAL;
+  }
+  *opstats = stats[op];
+  return 0;
+}
+
+
+/** Writes the collected statistics in JSON format.
+ *  \param fname  Name of the file ("-" for standard error).
+ *  \return 0 on success, errno value otherwise.
+ */
+int fortyxima_filesys_stats_write(const char *fname)
+{
+  FILE *fp;
+  int op, ii, status;
+
+  fp = strcmp(fname, "-") ? fopen(fname, "w") : stderr;
+  if (fp == NULL) {
+    return errno;
+  }
+  fprintf(fp, "{\n");
+  for (op = 0; op < STATS_NOPS; op++) {
+    fprintf(fp, "  \"%s\": {\"calls\": %lld, \"errors\": %lld, "
+	    "\"bytes\": %lld, \"time_ns\": %lld,\n"
+	    "    \"latency_log2_ns\": [", stats_opnames[op], stats[op].calls,
+	    stats[op].errors, stats[op].bytes, stats[op].time);
+    for (ii = 0; ii < STATS_NBUCKETS; ii++) {
+      fprintf(fp, ii ? ", %lld" : "%lld", stats[op].latency[ii]);
+    }
+    fprintf(fp, "]}%s\n", (op < STATS_NOPS - 1) ? "," : "");
+  }
+  fprintf(fp, "}\n");
+  status = ferror(fp) ? EIO : 0;
+  if (fp != stderr && fclose(fp) && !status) {
+    status = errno;
+  }
+  return status;
+}
+
+
+#ifdef __GNUC__
+/** Writes the statistics into the file specified in the environment. */
+static void stats_write_at_exit(void)
+{
+  fortyxima_filesys_stats_write(stats_fname);
+}
+
+
+/** Enables statistics if FORTYXIMA_FILESYS_STATS is set at program start.
+ *
+ *  \details The variable should contain the name of the file (or "-" for
+ *  standard error) the statistics are written to at program exit.
+ */
+__attribute__((constructor))
+static void stats_init_from_env(void)
+{
+  const char *fname;
+
+  fname = getenv("FORTYXIMA_FILESYS_STATS");
+  if (fname == NULL || fname[0] == '\0') {
+    return;
+  }
+  stats_fname = fortyxima_filesys_copystring(fname);
+  if (stats_fname != NULL && !atexit(stats_write_at_exit)) {
+    stats_enabled = 1;
+  }
+}
+#endif
+
+
+/** Values collected for each directory by fortyxima_filesys_treeusage. */
+enum treeusage_value {
+  TU_BYTES, TU_BLOCKS, TU_FILES, TU_DIRS, TU_ERRORS, TU_NVALUES
+};
+
+/** Default number of threads used by fortyxima_filesys_treeusage. */
+#define TU_DEFAULT_NTHREADS 8
+
+/** Directory, for which the usage is reported. */
+struct treeusage_node {
+  char *path;
+  int parent;
+  int depth;
+  long long values[TU_NVALUES];
+};
+
+/** Directory waiting to be scanned. */
+struct treeusage_job {
+  struct treeusage_job *next;
+  char *path;
+  /** Node the directory belongs to (the directory itself, if it is not
+   *  deeper than the maximal depth, its deepest reported ancestor otherwise).
+   */
+  int node;
+  int depth;
+  /** Size and blocks of the directory itself. */
+  long long bytes, blocks;
+};
+
+/** File with several hard links. */
+struct treeusage_inode {
+  dev_t dev;
+  ino_t ino;
+  /** Path of the link coming first in path order (NULL for unused slots). */
+  char *path;
+  /** Node the link with the first path belongs to. */
+  int node;
+  long long bytes, blocks;
+};
+
+/** State and result of a directory tree scan. */
+struct treeusage {
+  int maxdepth;
+  int nnodes, maxnodes;
+  struct treeusage_node *nodes;
+  struct treeusage_job *jobs;
+  /** Number of queued or currently processed jobs. */
+  int pending;
+  /** Whether memory allocation failed during the scan. */
+  int nomem;
+  size_t ninodes, maxinodes;
+  struct treeusage_inode *inodes;
+#ifdef WITH_PTHREAD
+  pthread_mutex_t mutex;
+  pthread_cond_t changed;
+#endif
+};
+
+#ifdef WITH_PTHREAD
+#define TU_LOCK(tu) pthread_mutex_lock(&(tu)->mutex)
+#define TU_UNLOCK(tu) pthread_mutex_unlock(&(tu)->mutex)
+#define TU_WAIT(tu) pthread_cond_wait(&(tu)->changed, &(tu)->mutex)
+#define TU_BROADCAST(tu) pthread_cond_broadcast(&(tu)->changed)
+#else
+#define TU_LOCK(tu)
+#define TU_UNLOCK(tu)
+#define TU_WAIT(tu)
+#define TU_BROADCAST(tu)
+#endif
+
+
+/** Compares paths so that each directory directly precedes its subtree. */
+static int treeusage_pathcmp(const char *path1, const char *path2)
+{
+  const unsigned char *s1, *s2;
+  int c1, c2;
+
+  s1 = (const unsigned char *) path1;
+  s2 = (const unsigned char *) path2;
+  for (; *s1 && *s1 == *s2; s1++, s2++) ;
+  c1 = (*s1 == '/') ? 1 : (*s1 ? *s1 + 1 : 0);
+  c2 = (*s2 == '/') ? 1 : (*s2 ? *s2 + 1 : 0);
+  return c1 - c2;
+}
+
+
+/** Returns the slot of a file in a hash table (or the empty slot for it). */
+static struct treeusage_inode *treeusage_find_inode(
+    struct treeusage_inode *inodes, size_t maxinodes, dev_t dev, ino_t ino)
+{
+  size_t pos;
+
+  pos = ((size_t) ino * 2654435761u + (size_t) dev) % maxinodes;
+  while (inodes[pos].path != NULL
+	 && (inodes[pos].dev != dev || inodes[pos].ino != ino)) {
+    pos = (pos + 1) % maxinodes;
+  }
+  return &inodes[pos];
+}
+
+
+/** Registers a link to a file with several hard links (lock must be held).
+ *
+ *  \details The file is attributed to the node of the link with the first
+ *  path in path order, so that the result does not depend on the order
+ *  the links are found by the threads.
+ *
+ *  \param tu  Scan state.
+ *  \param statbuf  Status of the file.
+ *  \param path  Path of the link.
+ *  \param node  Node the link belongs to.
+ */
+static void treeusage_add_link(struct treeusage *tu,
+			       const struct stat *statbuf, const char *path,
+			       int node)
+{
+  struct treeusage_inode *inodes, *entry;
+  size_t newmax, ii;
+  char *pathcopy;
+
+  if (2 * (tu->ninodes + 1) > tu->maxinodes) {
+    newmax = tu->maxinodes ? 2 * tu->maxinodes : 1024;
+    inodes = (struct treeusage_inode *)
+      calloc(newmax, sizeof(struct treeusage_inode));
+    if (inodes == NULL) {
+      tu->nomem = 1;
+      return;
+    }
+    for (ii = 0; ii < tu->maxinodes; ii++) {
+      if (tu->inodes[ii].path != NULL) {
+	*treeusage_find_inode(inodes, newmax, tu->inodes[ii].dev,
+			      tu->inodes[ii].ino) = tu->inodes[ii];
+      }
+    }
+    free(tu->inodes);
+    tu->inodes = inodes;
+    tu->maxinodes = newmax;
+  }
+  entry = treeusage_find_inode(tu->inodes, tu->maxinodes, statbuf->st_dev,
+			       statbuf->st_ino);
+  if (entry->path != NULL && treeusage_pathcmp(path, entry->path) >= 0) {
+    return;
+  }
+  pathcopy = fortyxima_filesys_copystring(path);
+  if (pathcopy == NULL) {
+    tu->nomem = 1;
+    return;
+  }
+  if (entry->path == NULL) {
+    entry->dev = statbuf->st_dev;
+    entry->ino = statbuf->st_ino;
+    entry->bytes = (long long) statbuf->st_size;
+    entry->blocks = (long long) statbuf->st_blocks;
+    tu->ninodes++;
+  }
+  free(entry->path);
+  entry->path = pathcopy;
+  entry->node = node;
+}
+
+
+/** Creates a new node (lock must be held).
+ *  \return Index of the node or -1 if allocation failed.
+ */
+static int treeusage_add_node(struct treeusage *tu, const char *path,
+			      int parent, int depth)
+{
+  struct treeusage_node *nodes;
+  int newmax;
+
+  if (tu->nnodes == tu->maxnodes) {
+    newmax = 2 * tu->maxnodes + 16;
+    nodes = (struct treeusage_node *)
+      realloc(tu->nodes, sizeof(struct treeusage_node) * newmax);
+    if (nodes == NULL) {
+      return -1;
+    }
+    tu->nodes = nodes;
+    tu->maxnodes = newmax;
+  }
+  nodes = &tu->nodes[tu->nnodes];
+  memset(nodes, 0, sizeof(struct treeusage_node));
+  nodes->path = fortyxima_filesys_copystring(path);
+  if (nodes->path == NULL) {
+    return -1;
+  }
+  nodes->parent = parent;
+  nodes->depth = depth;
+  return tu->nnodes++;
+}
+
+
+/** Queues a directory for scanning (lock must be held).
+ *  \return 0 on success, ENOMEM if allocation failed.
+ */
+static int treeusage_add_job(struct treeusage *tu, const char *path,
+			     int node, int depth, const struct stat *statbuf)
+{
+  struct treeusage_job *job;
+
+  job = (struct treeusage_job *) malloc(sizeof(struct treeusage_job));
+  if (job == NULL) {
+    return ENOMEM;
+  }
+  job->path = fortyxima_filesys_copystring(path);
+  if (job->path == NULL) {
+    free(job);
+    return ENOMEM;
+  }
+  job->node = node;
+  job->depth = depth;
+  job->bytes = (long long) statbuf->st_size;
+  job->blocks = (long long) statbuf->st_blocks;
+  job->next = tu->jobs;
+  tu->jobs = job;
+  tu->pending++;
+  return 0;
+}
+
+
+/** Scans one directory, queueing its subdirectories. */
+static void treeusage_scan(struct treeusage *tu, struct treeusage_job *job)
+{
+  long long values[TU_NVALUES];
+  struct dirent *ep;
+  struct stat statbuf;
+  char *subpath;
+  const char *separator;
+  size_t pathlen;
+  int node, fd, ii;
+  DIR *dp;
+
+  memset(values, 0, sizeof(values));
+  values[TU_BYTES] = job->bytes;
+  values[TU_BLOCKS] = job->blocks;
+  node = job->node;
+  if (tu->maxdepth < 0 || job->depth <= tu->maxdepth) {
+    TU_LOCK(tu);
+    node = treeusage_add_node(tu, job->path, job->node, job->depth);
+    TU_UNLOCK(tu);
+    if (node < 0) {
+      tu->nomem = 1;
+      return;
+    }
+  }
+  /* Root may be a symbolic link (already checked to point to a directory) */
+  fd = open(job->path, O_RDONLY | O_DIRECTORY | O_CLOEXEC
+	    | (job->depth ? O_NOFOLLOW : 0));
+  dp = (fd < 0) ? NULL : fdopendir(fd);
+  if (dp == NULL) {
+    if (fd >= 0) {
+      close(fd);
+    }
+    values[TU_ERRORS]++;
+  }
+  else {
+    pathlen = strlen(job->path);
+    separator = (pathlen && job->path[pathlen - 1] == '/') ? "" : "/";
+    subpath = NULL;
+    while ((ep = readdir(dp))) {
+      if (!strcmp(ep->d_name, ".") || !strcmp(ep->d_name, "..")) {
+	continue;
+      }
+      if (fstatat(dirfd(dp), ep->d_name, &statbuf, AT_SYMLINK_NOFOLLOW)) {
+	values[TU_ERRORS]++;
+	continue;
+      }
+      if (S_ISDIR(statbuf.st_mode) || statbuf.st_nlink > 1) {
+	free(subpath);
+	subpath = (char *) malloc(pathlen + strlen(ep->d_name) + 2);
+	if (subpath == NULL) {
+	  tu->nomem = 1;
+	  break;
+	}
+	sprintf(subpath, "%s%s%s", job->path, separator, ep->d_name);
+      }
+      if (S_ISDIR(statbuf.st_mode)) {
+	values[TU_DIRS]++;
+	TU_LOCK(tu);
+	if (treeusage_add_job(tu, subpath, node, job->depth + 1, &statbuf)) {
+	  tu->nomem = 1;
+	}
+	TU_BROADCAST(tu);
+	TU_UNLOCK(tu);
+	continue;
+      }
+      if (statbuf.st_nlink > 1) {
+	/* Counted after the scan, once all links are known */
+	TU_LOCK(tu);
+	treeusage_add_link(tu, &statbuf, subpath, node);
+	TU_UNLOCK(tu);
+	continue;
+      }
+      values[TU_FILES]++;
+      values[TU_BYTES] += (long long) statbuf.st_size;
+      values[TU_BLOCKS] += (long long) statbuf.st_blocks;
+    }
+    free(subpath);
+    closedir(dp);
+  }
+  TU_LOCK(tu);
+  for (ii = 0; ii < TU_NVALUES; ii++) {
+    tu->nodes[node].values[ii] += values[ii];
+  }
+  TU_UNLOCK(tu);
+}
+
+
+/** Processes queued directories until all directories have been scanned. */
+static void *treeusage_worker(void *arg)
+{
+  struct treeusage *tu;
+  struct treeusage_job *job;
+
+  tu = (struct treeusage *) arg;
+  TU_LOCK(tu);
+  for (;;) {
+    while (tu->jobs == NULL && tu->pending > 0) {
+      TU_WAIT(tu);
+    }
+    if (tu->jobs == NULL) {
+      break;
+    }
+    job = tu->jobs;
+    tu->jobs = job->next;
+    TU_UNLOCK(tu);
+    treeusage_scan(tu, job);
+    free(job->path);
+    free(job);
+    TU_LOCK(tu);
+    tu->pending--;
+    if (tu->pending == 0) {
+      TU_BROADCAST(tu);
+    }
+  }
+  TU_UNLOCK(tu);
+  return NULL;
+}
+
+
+/** Compares nodes so that each directory directly precedes its subtree. */
+static int treeusage_compare(const void *p1, const void *p2)
+{
+  return treeusage_pathcmp(((const struct treeusage_node *) p1)->path,
+			   ((const struct treeusage_node *) p2)->path);
+}
+
+
+/** Frees the result of a directory tree scan.
+ *  \param tu  Scan result (may be NULL).
+ */
+void fortyxima_filesys_treeusage_free(struct treeusage *tu)
+{
+  int ii;
+
+  if (tu == NULL) {
+    return;
+  }
+  for (ii = 0; ii < tu->nnodes; ii++) {
+    free(tu->nodes[ii].path);
+  }
+  free(tu->nodes);
+  for (ii = 0; ii < (int) tu->maxinodes; ii++) {
+    free(tu->inodes[ii].path);
+  }
+  free(tu->inodes);
+#ifdef WITH_PTHREAD
+  pthread_mutex_destroy(&tu->mutex);
+  pthread_cond_destroy(&tu->changed);
+#endif
+  free(tu);
+}
+
+
+/** Determines the disk usage of a directory tree.
+ *
+ *  \details The directories are scanned in parallel by several threads.
+ *  Symbolic links are not followed (except for the root itself). Files with
+ *  several hard links within the tree are only counted once, in the
+ *  directories containing their first link in path order, so that the
+ *  result does not depend on the scan order.
+ *
+ *  \param path  Root of the tree.
+ *  \param depth  Maximal depth of the directories, whose usage should be
+ *      reported (0: only the root, negative: all directories). The usage of
+ *      deeper directories is included in their ancestors.
+ *  \param nthreads  Number of threads to use (non-positive: default).
+ *  \param error  0 on success, errno value otherwise.
+ *  \return Scan result (NULL on error) with the directories ordered so that
+ *      each directory directly precedes its subdirectories. It should be
+ *      freed with fortyxima_filesys_treeusage_free().
+ */
+struct treeusage *fortyxima_filesys_treeusage(const char *path, int depth,
+					      int nthreads, int *error)
+{
+  struct treeusage *tu;
+  struct stat statbuf;
+  long long *values;
+  int ii, jj;
+#ifdef WITH_PTHREAD
+  pthread_t *threads;
+  int nstarted;
+#endif
+
+  if (stat(path, &statbuf)) {
+    *error = errno;
+    return NULL;
+  }
+  if (!S_ISDIR(statbuf.st_mode)) {
+    *error = ENOTDIR;
+    return NULL;
+  }
+  tu = (struct treeusage *) calloc(1, sizeof(struct treeusage));
+  if (tu == NULL) {
+    *error = ENOMEM;
+    return NULL;
+  }
+  tu->maxdepth = depth;
+#ifdef WITH_PTHREAD
+  pthread_mutex_init(&tu->mutex, NULL);
+  pthread_cond_init(&tu->changed, NULL);
+#endif
+  if (treeusage_add_job(tu, path, -1, 0, &statbuf)) {
+    fortyxima_filesys_treeusage_free(tu);
+    *error = ENOMEM;
+    return NULL;
+  }
+
+#ifdef WITH_PTHREAD
+  if (nthreads <= 0) {
+    nthreads = TU_DEFAULT_NTHREADS;
+  }
+  nstarted = 0;
+  threads = (pthread_t *) malloc(sizeof(pthread_t) * nthreads);
+  if (threads != NULL) {
+    for (; nstarted < nthreads - 1; nstarted++) {
+      if (pthread_create(&threads[nstarted], NULL, treeusage_worker, tu)) {
+	break;
+      }
+    }
+  }
+  treeusage_worker(tu);
+  for (ii = 0; ii < nstarted; ii++) {
+    pthread_join(threads[ii], NULL);
+  }
+  free(threads);
+#else
+  treeusage_worker(tu);
+#endif
+
+  if (tu->nomem) {
+    /* Result is incomplete */
+    fortyxima_filesys_treeusage_free(tu);
+    *error = ENOMEM;
+    return NULL;
+  }
+  for (ii = 0; ii < (int) tu->maxinodes; ii++) {
+    if (tu->inodes[ii].path != NULL) {
+      values = tu->nodes[tu->inodes[ii].node].values;
+      values[TU_FILES]++;
+      values[TU_BYTES] += tu->inodes[ii].bytes;
+      values[TU_BLOCKS] += tu->inodes[ii].blocks;
+    }
+  }
+  /* Nodes are created after their parents, so a reverse loop sums up all */
+  for (ii = tu->nnodes - 1; ii > 0; ii--) {
+    for (jj = 0; jj < TU_NVALUES; jj++) {
+      tu->nodes[tu->nodes[ii].parent].values[jj] += tu->nodes[ii].values[jj];
+    }
+  }
+  qsort(tu->nodes, tu->nnodes, sizeof(struct treeusage_node),
+	treeusage_compare);
+  *error = 0;
+  return tu;
+}
+
+
+/** Returns the number of directories in a scan result. */
+int fortyxima_filesys_treeusage_size(const struct treeusage *tu)
+{
+  return (tu == NULL) ? 0 : tu->nnodes;
+}
+
+
+/** Returns the usage of a directory in a scan result.
+ *  \param tu  Scan result.
+ *  \param ind  Index of the directory (0 <= ind < number of directories).
+ *  \param path  Path of the directory on return (owned by the scan result).
+ *  \param depth  Depth of the directory on return.
+ *  \param values  Number of bytes, of 512 byte blocks, of files (excluding
+ *      directories) and of directories in the subtree (excluding the
+ *      directory itself) and number of entries which could not be scanned.
+ */
+void fortyxima_filesys_treeusage_entry(const struct treeusage *tu, int ind,
+				       const char **path, int *depth,
+				       long long *values)
+{
+  memcpy(values, tu->nodes[ind].values, sizeof(long long) * TU_NVALUES);
+  *path = tu->nodes[ind].path;
+  *depth = tu->nodes[ind].depth;
+}
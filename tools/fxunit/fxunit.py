@@ -29,10 +29,15 @@ END_SUBROUTINE_PATTERN = re.compile(
 CLASS_DUMMY_ARG_PATTERN = re.compile(
     r'^\s*class\(\s*(\w+)\s*\)[^:]*::\s*(\w+)\s*$', RE_FLAGS)
 
+USE_PATTERN = re.compile(
+    r'^\s*use\b(?:\s*,\s*\w+\s*::|\s*::)?\s*(\w+)', RE_FLAGS)
+
 F_CONT_CHAR = '&'
 
 F_LINE_LENGTH = 80
 
+NAME_SEPARATOR = '_'
+
 
 def get_modules(txt):
     modules = []
@@ -47,6 +52,10 @@ def get_modules(txt):
     return modules
 
 
+def get_used_modules(txt):
+    return set([ match.group(1).lower() for match in USE_PATTERN.finditer(txt) ])
+
+
 def get_types_and_procedures(txt, start, end):
     types = {}
     for type_match in TYPE_PATTERN.finditer(txt, start, end):
@@ -147,6 +156,14 @@ def get_entities_from_files(files):
     return modules, instances, calls
 
 
+def get_test_name(modname, subname):
+    if subname.startswith('test'):
+        subname = subname[4:]
+    if subname.startswith('_'):
+        subname = subname[1:]
+    return ''.join([ modname, NAME_SEPARATOR, subname ])
+
+
 def fortran_join(lines):
     fortran_lines = []
     fll0 = F_LINE_LENGTH
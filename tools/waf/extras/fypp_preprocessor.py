@@ -61,6 +61,8 @@ class fypp_preprocessor(Task.Task):
 	ext_in = [ '.F90' ]
 	ext_out = [ '.f90' ]
 
+	vars = [ 'FYPP_FLAGS', 'DEFINES', 'INCLUDES', 'FYPP_VERSION' ]
+
 	color = 'CYAN'
 
 	def keyword(self):
@@ -0,0 +1,250 @@
+'''Content addressed cache for the outputs of the Fypp and Fortran tasks.
+
+The cache directory can be shared between different build directories and
+configurations. The key of a cache entry is derived from the content of the
+input files and the files the task depends on (included files, used modules),
+the effective flags and defines and the identity of the tools (Fypp version,
+compiler name and version). Absolute paths of the source and build directories
+are replaced by placeholders, so that also different checkouts can reuse each
+others outputs.
+'''
+import os
+import shutil
+from waflib import Logs, Task, Utils
+
+# Task types whose outputs are cached
+CACHED_TASKS = ('fypp_preprocessor', 'fc')
+
+# Environment variables describing the identity of the tool running the task
+IDENTITY_VARS = {
+    'fypp_preprocessor': [ 'FYPP_VERSION' ],
+    'fc': [ 'FC_NAME', 'FC_VERSION' ],
+}
+
+# Text outputs, in which the source and build directories are relocated
+RELOCATABLE_EXTS = ('.f90', )
+
+# Dependencies not influencing the output. (Waf adds the objects of the tasks
+# creating the used modules, which contain the absolute path of the source.)
+IGNORED_DEP_EXTS = ('.o', '.obj')
+
+SRCDIR_PLACEHOLDER = '@FX_SRCDIR@'
+BLDDIR_PLACEHOLDER = '@FX_BLDDIR@'
+
+# Prefix for temporary entries while they are being written or deleted
+TMP_PREFIX = 'tmp-'
+
+
+def enable_cache(bld, cachedir, maxsize):
+    '''Makes the Fypp and Fortran tasks use a shared cache directory.
+
+    :param bld: Build context.
+    :param cachedir: Directory containing the cached entries.
+    :param maxsize: Maximal size of the cache in bytes. If the build stored new
+        entries and the limit is exceeded, the least recently used entries are
+        removed at the end of the build.
+    '''
+    bld.fxcache = FileCache(bld, cachedir, maxsize)
+    for name in CACHED_TASKS:
+        cls = Task.classes.get(name)
+        if cls is not None:
+            _wrap_task_run(cls)
+    bld.add_post_fun(finish_cache)
+
+
+def finish_cache(bld):
+    cache = bld.fxcache
+    if cache.stored:
+        cache.trim()
+    if cache.hits or cache.misses:
+        Logs.pprint('CYAN', 'Cache: %d hits, %d misses'
+                    % (cache.hits, cache.misses))
+
+
+def _wrap_task_run(cls):
+    run = cls.run
+    if getattr(run, 'fxcached', False):
+        return
+
+    def cached_run(self):
+        cache = getattr(self.generator.bld, 'fxcache', None)
+        if cache is None:
+            return run(self)
+        key = cache.get_key(self)
+        if cache.retrieve(self, key):
+            return 0
+        ret = run(self)
+        if not ret:
+            cache.store(self, key)
+        return ret
+
+    cached_run.fxcached = True
+    cls.run = cached_run
+
+
+class FileCache(object):
+
+    '''Cache storing task outputs in directories named by the task key.'''
+
+    def __init__(self, bld, cachedir, maxsize):
+        self._cachedir = os.path.abspath(cachedir)
+        self._maxsize = maxsize
+        self._srcdir = bld.srcnode.abspath()
+        self._blddir = bld.bldnode.abspath()
+        self._lock = Utils.threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        if not os.path.isdir(self._cachedir):
+            os.makedirs(self._cachedir)
+
+
+    def get_key(self, tsk):
+        '''Returns the cache key of a task (hexadecimal string).'''
+        bld = tsk.generator.bld
+        clsname = tsk.__class__.__name__
+        m = Utils.md5()
+        m.update(clsname.encode())
+        m.update(tsk.hcode)
+        deps = bld.node_deps.get(tsk.uid(), [])
+        for node in tsk.inputs:
+            m.update(self._hash_file(node))
+        depsigs = [ (node.name, self._hash_file(node))
+                    for node in set(tsk.dep_nodes + deps)
+                    if not node.name.endswith(IGNORED_DEP_EXTS) ]
+        depsigs.sort()
+        for name, sig in depsigs:
+            m.update(name.encode())
+            m.update(sig)
+        names = list(tsk.vars) + getattr(tsk, 'dep_vars', [])
+        names += IDENTITY_VARS.get(clsname, [])
+        values = [ self._relocate(tsk.env[name]) for name in names ]
+        m.update(Utils.h_list([ names, values ]))
+        return Utils.to_hex(m.digest())
+
+
+    def retrieve(self, tsk, key):
+        '''Copies the cached outputs of a task to their places.
+
+        :return: True if all outputs could be restored from the cache.
+        '''
+        entry = self._entry_dir(key)
+        try:
+            for node in tsk.outputs:
+                self._copy_from(os.path.join(entry, node.name), node)
+            os.utime(entry, None)
+        except EnvironmentError:
+            self._count('misses')
+            return False
+        Logs.debug('fxcache: restored %r from %s' % (tsk.outputs, entry))
+        self._count('hits')
+        return True
+
+
+    def store(self, tsk, key):
+        '''Stores the outputs of a task in the cache.'''
+        entry = self._entry_dir(key)
+        if os.path.isdir(entry):
+            return
+        tmpdir = os.path.join(self._cachedir,
+                              TMP_PREFIX + Utils.to_hex(os.urandom(8)))
+        try:
+            os.mkdir(tmpdir)
+            for node in tsk.outputs:
+                self._copy_to(node, os.path.join(tmpdir, node.name))
+            parent = os.path.dirname(entry)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            os.rename(tmpdir, entry)
+        except EnvironmentError as exc:
+            # Entry may have been created by a concurrent build meanwhile
+            Logs.debug('fxcache: could not store %s: %s' % (entry, exc))
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        self._count('stored')
+
+
+    def trim(self):
+        '''Removes the least recently used entries until the cache fits.'''
+        entries = []
+        total = 0
+        for subdir in os.listdir(self._cachedir):
+            subpath = os.path.join(self._cachedir, subdir)
+            if subdir.startswith(TMP_PREFIX) or not os.path.isdir(subpath):
+                continue
+            for name in os.listdir(subpath):
+                entry = os.path.join(subpath, name)
+                try:
+                    mtime = os.stat(entry).st_mtime
+                    size = sum([ os.path.getsize(os.path.join(entry, fname))
+                                 for fname in os.listdir(entry) ])
+                except EnvironmentError:
+                    continue
+                entries.append((mtime, size, entry))
+                total += size
+        entries.sort()
+        for mtime, size, entry in entries:
+            if total <= self._maxsize:
+                break
+            tmpdir = os.path.join(self._cachedir,
+                                  TMP_PREFIX + Utils.to_hex(os.urandom(8)))
+            try:
+                os.rename(entry, tmpdir)
+            except EnvironmentError:
+                continue
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            total -= size
+
+
+    def _entry_dir(self, key):
+        return os.path.join(self._cachedir, key[:2], key)
+
+
+    def _copy_from(self, fname, node):
+        if node.name.endswith(RELOCATABLE_EXTS):
+            txt = Utils.readf(fname, 'rb')
+            txt = txt.replace(SRCDIR_PLACEHOLDER.encode(),
+                              self._srcdir.encode())
+            txt = txt.replace(BLDDIR_PLACEHOLDER.encode(),
+                              self._blddir.encode())
+            Utils.writef(node.abspath(), txt, 'wb')
+        else:
+            shutil.copyfile(fname, node.abspath())
+
+
+    def _copy_to(self, node, fname):
+        if node.name.endswith(RELOCATABLE_EXTS):
+            Utils.writef(fname, self._read_relocated(node), 'wb')
+        else:
+            shutil.copyfile(node.abspath(), fname)
+
+
+    def _hash_file(self, node):
+        if node.name.endswith(RELOCATABLE_EXTS):
+            m = Utils.md5()
+            m.update(self._read_relocated(node))
+            return m.digest()
+        return Utils.h_file(node.abspath())
+
+
+    def _read_relocated(self, node):
+        txt = Utils.readf(node.abspath(), 'rb')
+        txt = txt.replace(self._blddir.encode(), BLDDIR_PLACEHOLDER.encode())
+        return txt.replace(self._srcdir.encode(), SRCDIR_PLACEHOLDER.encode())
+
+
+    def _relocate(self, value):
+        if isinstance(value, str):
+            value = value.replace(self._blddir, BLDDIR_PLACEHOLDER)
+            return value.replace(self._srcdir, SRCDIR_PLACEHOLDER)
+        elif isinstance(value, (list, tuple)):
+            return [ self._relocate(item) for item in value ]
+        return value
+
+
+    def _count(self, counter):
+        self._lock.acquire()
+        try:
+            setattr(self, counter, getattr(self, counter) + 1)
+        finally:
+            self._lock.release()
@@ -1,6 +1,8 @@
 # Import all settings needed for Fortyxima compilation
-import os.path
+import os
+import fxcache
 import fxtools
+from waflib import Options
 
 
 def options(opt):
@@ -10,6 +12,20 @@ def options(opt):
           ' Default: all available components.'
     opt.add_option('--with-components', action='store', default=None,
                    metavar='COMPONENTS', dest='components', help=msg)
+    msg = 'Profile the build and write a Chrome trace and a report about ' \
+          'the critical path into the build directory'
+    opt.add_option('--profile-build', action='store_true', default=False,
+                   dest='profile_build', help=msg)
+    msg = 'Directory of the cache for Fypp and Fortran compilation outputs, ' \
+          'which can be shared between build directories. Default: value of ' \
+          'the FORTYXIMA_CACHE environment variable (no caching if unset)'
+    opt.add_option('--fx-cache', action='store',
+                   default=os.environ.get('FORTYXIMA_CACHE', None),
+                   metavar='DIR', dest='fx_cache', help=msg)
+    msg = 'Maximal size of the cache in MB (least recently used entries are ' \
+          'removed). Default: 1024'
+    opt.add_option('--fx-cache-size', action='store', type='int',
+                   default=1024, metavar='MB', dest='fx_cache_size', help=msg)
 
 
 def configure(conf):
@@ -24,3 +40,8 @@ def configure(conf):
 
 def build(bld):
     fxtools.fix_fc_keyword()
+    if Options.options.profile_build:
+        fxtools.enable_profiling(bld)
+    if Options.options.fx_cache:
+        fxcache.enable_cache(bld, Options.options.fx_cache,
+                             Options.options.fx_cache_size * 1024 * 1024)
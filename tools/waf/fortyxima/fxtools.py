@@ -1,3 +1,14 @@
+import json
+import time
+from waflib import Logs, Task, Utils
+
+# Files (in the build directory) the build profile is written to
+PROFILE_TRACE_FILE = 'fxprofile.json'
+PROFILE_REPORT_FILE = 'fxprofile.txt'
+
+# Nr. of entries of the critical path shown in the profile report
+PROFILE_MAX_PATH_ENTRIES = 30
+
 
 def fix_fc_keyword():
     from waflib.Tools.fc import fc
@@ -5,3 +16,168 @@ def fix_fc_keyword():
         return 'Compiling'
     fc.keyword = keyword
 
+
+def enable_profiling(bld):
+    '''Records start and end time and the worker thread of every executed task.
+
+    At the end of the build a Chrome trace file (to be loaded into
+    chrome://tracing) and a text report with the critical path and the times
+    spent in the various task types is written into the build directory.
+    '''
+    bld.fxprofile = []
+    _wrap_task_process()
+    bld.add_post_fun(write_profile)
+
+
+def _wrap_task_process():
+    process = Task.TaskBase.process
+    if getattr(process, 'fxprofiled', False):
+        return
+
+    def profiled_process(self):
+        records = getattr(self.generator.bld, 'fxprofile', None)
+        if records is None:
+            return process(self)
+        # Wrapping run() of the instance, as process() hands the task back to
+        # the main thread before it returns.
+        run = self.run
+        def timed_run():
+            start = time.time()
+            try:
+                return run()
+            finally:
+                end = time.time()
+                del self.run
+                thread = Utils.threading.current_thread().name
+                records.append((self, start, end, thread))
+        self.run = timed_run
+        return process(self)
+
+    profiled_process.fxprofiled = True
+    Task.TaskBase.process = profiled_process
+
+
+def write_profile(bld):
+    records = getattr(bld, 'fxprofile', [])
+    if not records:
+        return
+    records = sorted(records, key=lambda rec: rec[1])
+    t0 = records[0][1]
+    tracenode = bld.bldnode.make_node(PROFILE_TRACE_FILE)
+    tracenode.write(json.dumps(get_chrome_trace(records, t0), indent=1))
+    reportnode = bld.bldnode.make_node(PROFILE_REPORT_FILE)
+    reportnode.write(get_profile_report(records, t0))
+    Logs.pprint('CYAN', 'Build profile written to %s and %s'
+                % (tracenode.abspath(), reportnode.abspath()))
+
+
+def get_chrome_trace(records, t0):
+    '''Returns the profile as a dictionary in Chrome trace event format.'''
+    events = []
+    threadids = {}
+    for tsk, start, end, thread in records:
+        if thread not in threadids:
+            threadids[thread] = len(threadids) + 1
+            events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                            'tid': threadids[thread],
+                            'args': { 'name': thread } })
+        events.append({ 'name': _task_name(tsk), 'cat': _task_category(tsk),
+                        'ph': 'X', 'pid': 1, 'tid': threadids[thread],
+                        'ts': int((start - t0) * 1e6),
+                        'dur': int((end - start) * 1e6) })
+    return { 'traceEvents': events, 'displayTimeUnit': 'ms' }
+
+
+def get_critical_path(records):
+    '''Returns the chain of dependent tasks with the longest total duration.
+
+    :param records: Profile records sorted by start time.
+    :return: List of records along the critical path.
+    '''
+    index = dict([ (id(rec[0]), ii) for ii, rec in enumerate(records) ])
+    length = [ 0.0 ] * len(records)
+    pred = [ None ] * len(records)
+    # Tasks start only after their dependencies ended, so sorting by start
+    # time yields a topological order.
+    for ii, (tsk, start, end, thread) in enumerate(records):
+        for dep in getattr(tsk, 'run_after', []):
+            jj = index.get(id(dep))
+            if jj is None:
+                continue
+            if pred[ii] is None or length[jj] > length[pred[ii]]:
+                pred[ii] = jj
+        length[ii] = end - start
+        if pred[ii] is not None:
+            length[ii] += length[pred[ii]]
+    ii = max(range(len(records)), key=lambda jj: length[jj])
+    path = []
+    while ii is not None:
+        path.append(records[ii])
+        ii = pred[ii]
+    path.reverse()
+    return path
+
+
+def get_profile_report(records, t0):
+    '''Returns a human readable report of the build profile.'''
+    wall = max([ rec[2] for rec in records ]) - t0
+    busy = sum([ rec[2] - rec[1] for rec in records ])
+    path = get_critical_path(records)
+    pathlen = sum([ rec[2] - rec[1] for rec in path ])
+    threads = set([ rec[3] for rec in records ])
+
+    totals = {}
+    for tsk, start, end, thread in records:
+        cat = _task_category(tsk)
+        count, total, onpath = totals.get(cat, (0, 0.0, 0.0))
+        totals[cat] = (count + 1, total + end - start, onpath)
+    for tsk, start, end, thread in path:
+        cat = _task_category(tsk)
+        count, total, onpath = totals[cat]
+        totals[cat] = (count, total, onpath + end - start)
+
+    lines = []
+    lines.append('Wall clock time:      %10.3f s' % wall)
+    lines.append('Sum of task times:    %10.3f s' % busy)
+    lines.append('Critical path:        %10.3f s' % pathlen)
+    lines.append('Worker threads used:  %10d' % len(threads))
+    lines.append('Average parallelism:  %10.2f'
+                 % (busy / wall if wall else 0.0))
+    lines.append('Max. parallelism:     %10.2f (sum of task times / critical '
+                 'path)' % (busy / pathlen if pathlen else 0.0))
+    lines.append('')
+    lines.append('Time per task type:')
+    lines.append('%-20s %6s %12s %8s %14s' % ('Type', 'Tasks', 'Total [s]',
+                                             'Share', 'On path [s]'))
+    for cat, (count, total, onpath) in sorted(totals.items(),
+                                              key=lambda item: -item[1][1]):
+        share = 100.0 * total / busy if busy else 0.0
+        lines.append('%-20s %6d %12.3f %7.1f%% %14.3f'
+                     % (cat, count, total, share, onpath))
+    lines.append('')
+    lines.append('Critical path (%d tasks):' % len(path))
+    lines.append('%10s %10s  %-20s %s' % ('Start [s]', 'Time [s]', 'Type',
+                                         'Task'))
+    shown = path
+    if len(path) > PROFILE_MAX_PATH_ENTRIES:
+        shown = sorted(path, key=lambda rec: rec[1] - rec[2])
+        shown = sorted(shown[:PROFILE_MAX_PATH_ENTRIES], key=lambda rec: rec[1])
+        lines.append('(showing the %d longest entries)'
+                     % PROFILE_MAX_PATH_ENTRIES)
+    for tsk, start, end, thread in shown:
+        lines.append('%10.3f %10.3f  %-20s %s' % (start - t0, end - start,
+                                                  _task_category(tsk),
+                                                  _task_name(tsk)))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def _task_category(tsk):
+    return tsk.__class__.__name__
+
+
+def _task_name(tsk):
+    testname = getattr(tsk, 'testname', None)
+    if testname is not None:
+        return testname
+    return str(tsk)
@@ -1,7 +1,13 @@
-from waflib import Task, TaskGen, Utils, Logs, Options
+import json
+import os
+import time
+from waflib import Context, Task, TaskGen, Utils, Logs, Options
 
 INDENT_STR = ' ' * 4
 
+# Default file (in the build directory) storing the recorded test durations
+TIMINGS_FILE = 'fxunit_timings.json'
+
 testlock = Utils.threading.Lock()
 
 @TaskGen.feature('testdriver')
@@ -10,20 +16,33 @@ def make_tests(self):
     if getattr(self, 'link_task', None):
         tests = getattr(self, 'tests', [])
         tests += get_tests_from_files(self, getattr(self, 'testfiles', []))
+        self.bld.utest_expected = get_expected_tests(tests)
+        if Options.options.shard:
+            ishard, nshards = parse_shard(self.bld, Options.options.shard)
+            timings = read_test_timings(get_timings_file(self.bld))
+            expected = set(self.bld.utest_expected)
+            tests = [ test for test in tests if test in expected ]
+            tests = partition_tests(tests, nshards, timings)[ishard]
         for testname in tests:
             self.create_task('fxutest', self.link_task.outputs, 
                              testname=testname)
+        self.bld.add_post_fun(store_test_results)
         self.bld.add_post_fun(summary)
 
 
 @TaskGen.taskgen_method
-def add_test_result(self, result):
+def add_test_result(self, result, duration=None):
     report_test_result(result)
     self.utest_result = result
     try:
         self.bld.utest_results.append(result)
     except AttributeError:
         self.bld.utest_results = [ result ]
+    if duration is not None:
+        try:
+            self.bld.utest_durations[result[0]] = duration
+        except AttributeError:
+            self.bld.utest_durations = { result[0]: duration }
     retval = result[1] if Options.options.stop_on_failure else None
     return retval
 
@@ -40,6 +59,9 @@ class fxutest(Task.Task):
         excluded_tests = getattr(Options.options, 'exclude_test', None)
         if excluded_tests and self.testname in excluded_tests:
             return Task.SKIP_ME
+        selected_tests = getattr(self.generator.bld, 'selected_tests', None)
+        if selected_tests is not None and self.testname not in selected_tests:
+            return Task.SKIP_ME
         status = super(fxutest, self).runnable_status()
         if status == Task.SKIP_ME:
             status = Task.RUN_ME
@@ -51,14 +73,16 @@ class fxutest(Task.Task):
         cwd = self.inputs[0].parent.abspath()
         cmd = [ execname, self.testname ]
         Logs.debug('runner: %r' % (cmd, ))
+        starttime = time.time()
         proc = Utils.subprocess.Popen(
             cmd, cwd=cwd, stderr=Utils.subprocess.PIPE, 
             stdout=Utils.subprocess.PIPE)
         (stdout, stderr) = proc.communicate()
+        duration = time.time() - starttime
         result = (self.testname, proc.returncode, stdout, stderr)
         testlock.acquire()
         try:
-            return self.generator.add_test_result(result)
+            return self.generator.add_test_result(result, duration)
         finally:
             testlock.release()
 
@@ -81,7 +105,15 @@ class fxutest(Task.Task):
 
 
 def summary(bld):
-    results = getattr(bld, 'utest_results', [])
+    report_summary(bld, getattr(bld, 'utest_results', []))
+
+
+def report_summary(ctx, results):
+    '''Reports passed and failed tests and stops if any of them failed.
+
+    :param ctx: Context used to signalize the failure.
+    :param results: List of (testname, retcode, stdout, stderr) tuples.
+    '''
     if results:
         tests_passed = []
         tests_failed = []
@@ -125,7 +157,7 @@ def summary(bld):
         Logs.pprint('CYAN', 'Failed   ' + formstr % (failed, failed_rel))
 
         if failed:
-            bld.fatal('Some tests failed.')
+            ctx.fatal('Some tests failed.')
 
 
 def get_tests_from_files(tgen, files):
@@ -141,6 +173,243 @@ def get_tests_from_files(tgen, files):
     return tests
 
 
+def get_expected_tests(tests):
+    '''Returns the sorted names of all tests selected on the command line.'''
+    included_tests = getattr(Options.options, 'include_test', None)
+    excluded_tests = getattr(Options.options, 'exclude_test', None) or []
+    return sorted(set([ test for test in tests
+                        if (not included_tests or test in included_tests)
+                        and test not in excluded_tests ]))
+
+
+def parse_shard(bld, spec):
+    '''Parses a shard specification of the form K/N.
+
+    :return: Tuple with the zero based index of the shard and the number of
+        shards.
+    '''
+    try:
+        ishard, nshards = [ int(word) for word in spec.split('/') ]
+    except ValueError:
+        bld.fatal('Invalid shard specification %r (expected K/N)' % (spec, ))
+    if nshards < 1 or ishard < 1 or ishard > nshards:
+        bld.fatal('Invalid shard %r (need 1 <= K <= N)' % (spec, ))
+    return ishard - 1, nshards
+
+
+def partition_tests(tests, nshards, timings):
+    '''Splits tests into partitions with approximately equal total durations.
+
+    The partitioning only depends on the test names and the timings, so that
+    each shard gets the same result independent of where it is executed. Tests
+    without recorded duration are assumed to take the average time of the
+    known ones.
+
+    :param tests: Names of the tests.
+    :param nshards: Number of partitions.
+    :param timings: Dictionary with the recorded duration of the tests.
+    :return: List of nshards lists, each containing the tests of a partition in
+        the original order.
+    '''
+    known = [ timings[test] for test in set(tests) if test in timings ]
+    default = sum(known) / len(known) if known else 1.0
+    weighted = sorted([ (timings.get(test, default), test)
+                        for test in set(tests) ],
+                      key=lambda item: (-item[0], item[1]))
+    loads = [ 0.0 ] * nshards
+    shard_of_test = {}
+    for duration, test in weighted:
+        ishard = min(range(nshards), key=lambda ii: (loads[ii], ii))
+        loads[ishard] += duration
+        shard_of_test[test] = ishard
+    shards = [ [] for ii in range(nshards) ]
+    for test in tests:
+        shards[shard_of_test[test]].append(test)
+    return shards
+
+
+def get_timings_file(ctx):
+    '''Returns the name of the file with the recorded test durations.
+
+    :param ctx: Context. If it is not a build context, the build directory of
+        the last configuration is used. If that is unknown either, None is
+        returned.
+    '''
+    fname = Options.options.test_timings
+    if fname:
+        return fname
+    bldnode = getattr(ctx, 'bldnode', None)
+    if bldnode is not None:
+        return bldnode.make_node(TIMINGS_FILE).abspath()
+    if Context.out_dir:
+        return os.path.join(Context.out_dir, TIMINGS_FILE)
+    return None
+
+
+def read_test_timings(fname):
+    '''Reads the recorded test durations (empty dictionary if unavailable).'''
+    try:
+        fp = open(fname, 'r')
+    except IOError:
+        return {}
+    try:
+        return json.load(fp)
+    except ValueError:
+        Logs.warn('Ignoring invalid test timings file %r' % (fname, ))
+        return {}
+    finally:
+        fp.close()
+
+
+def write_test_timings(fname, durations):
+    '''Updates the recorded test durations with new values.'''
+    timings = {}
+    try:
+        fp = open(fname, 'r')
+    except IOError:
+        pass
+    else:
+        try:
+            timings = json.load(fp)
+        except ValueError:
+            pass
+        fp.close()
+    timings.update(durations)
+    fp = open(fname, 'w')
+    json.dump(timings, fp, indent=1, sort_keys=True)
+    fp.close()
+
+
+def store_test_results(bld):
+    '''Records the test durations and writes the results if requested.
+
+    Sharded runs do not update the timings file, as the other shards must
+    split the tests based on the same timings. Their durations are stored
+    in the result file and recorded by the mergetests command instead.
+    '''
+    results = getattr(bld, 'utest_results', [])
+    durations = getattr(bld, 'utest_durations', {})
+    if durations and not Options.options.shard:
+        write_test_timings(get_timings_file(bld), durations)
+    if Options.options.test_results:
+        shard = None
+        if Options.options.shard:
+            shard = list(parse_shard(bld, Options.options.shard))
+        write_test_results(Options.options.test_results, results, durations,
+                           getattr(bld, 'utest_expected', []), shard)
+
+
+def write_test_results(fname, results, durations, expected, shard):
+    '''Writes test results into a file, which can be merged later.
+
+    :param expected: Names of all tests of the (unsharded) test run.
+    :param shard: [ zero based index, number of shards ] or None.
+    '''
+    entries = []
+    for testname, retcode, stdout, stderr in results:
+        entries.append({ 'name': testname, 'retcode': retcode,
+                         'stdout': _to_text(stdout),
+                         'stderr': _to_text(stderr),
+                         'duration': durations.get(testname, None) })
+    fp = open(fname, 'w')
+    json.dump({ 'results': entries, 'tests': expected, 'shard': shard }, fp,
+              indent=1)
+    fp.close()
+
+
+def read_test_results(fname):
+    '''Reads a test result file written by write_test_results().
+
+    :return: Tuple with list of results, dictionary of test durations, list of
+        all tests of the test run and shard ([ index, number of shards ] or
+        None).
+    '''
+    fp = open(fname, 'r')
+    try:
+        content = json.load(fp)
+    finally:
+        fp.close()
+    results = []
+    durations = {}
+    for entry in content['results']:
+        results.append((entry['name'], entry['retcode'], entry['stdout'],
+                        entry['stderr']))
+        if entry['duration'] is not None:
+            durations[entry['name']] = entry['duration']
+    return results, durations, content['tests'], content['shard']
+
+
+def _to_text(data):
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+
+class mergetestsContext(Context.Context):
+    '''merges the results of sharded test runs'''
+    cmd = 'mergetests'
+
+    def execute(self):
+        fnames = Options.options.merge_results
+        if not fnames:
+            self.fatal('No test result files specified (use --merge-results)')
+        results = []
+        durations = {}
+        expected = set()
+        shards = {}
+        for fname in fnames:
+            try:
+                res, dur, tests, shard = read_test_results(fname)
+            except (IOError, ValueError, KeyError, TypeError):
+                self.fatal('Could not read test results from %r' % (fname, ))
+            results += res
+            durations.update(dur)
+            expected.update(tests)
+            if shard is not None:
+                ishard, nshards = shard
+                if ishard in shards.get(nshards, {}):
+                    self.fatal('Shard %d/%d contained in %r and %r'
+                               % (ishard + 1, nshards,
+                                  shards[nshards][ishard], fname))
+                shards.setdefault(nshards, {})[ishard] = fname
+        check_merged_results(self, results, expected, shards)
+        timings_file = get_timings_file(self)
+        if timings_file and durations:
+            write_test_timings(timings_file, durations)
+        report_summary(self, results)
+
+
+def check_merged_results(ctx, results, expected, shards):
+    '''Stops if tests are duplicated or missing in merged results.
+
+    :param results: Merged results.
+    :param expected: Set with the names of all tests of the test runs.
+    :param shards: Dictionary mapping the number of shards to a dictionary,
+        which maps the shard indices to the files containing them.
+    '''
+    seen = set()
+    duplicates = set()
+    for result in results:
+        if result[0] in seen:
+            duplicates.add(result[0])
+        seen.add(result[0])
+    if duplicates:
+        ctx.fatal('Tests with multiple results: %s'
+                  % (', '.join(sorted(duplicates)), ))
+    if len(shards) > 1:
+        ctx.fatal('Merged results of different shard counts: %s'
+                  % (', '.join([ str(nn) for nn in sorted(shards) ]), ))
+    for nshards, found in shards.items():
+        missing = [ str(ii + 1) for ii in range(nshards) if ii not in found ]
+        if missing:
+            ctx.fatal('Missing results of shards %s (out of %d)'
+                      % (', '.join(missing), nshards))
+    missing = expected - seen
+    if missing:
+        ctx.fatal('Missing results of tests: %s'
+                  % (', '.join(sorted(missing)), ))
+
+
 def report_test_result(result):
     testname, retcode, stdout, stderr = result
     opts = Options.options
@@ -168,3 +437,17 @@ def options(opt):
     msg = 'Exclude test from unit testing'
     optgrp.add_option('--exclude-test', action='append', default=[],
                       metavar='TEST', help=msg)
+    msg = 'Run only the K-th of N partitions of the tests (balanced by the ' \
+          'recorded test durations)'
+    optgrp.add_option('--shard', action='store', default=None,
+                      metavar='K/N', help=msg)
+    msg = 'File with recorded test durations (default: %s in the build ' \
+          'directory)' % TIMINGS_FILE
+    optgrp.add_option('--test-timings', action='store', default=None,
+                      metavar='FILE', help=msg)
+    msg = 'Write test results into file (for the mergetests command)'
+    optgrp.add_option('--test-results', action='store', default=None,
+                      metavar='FILE', help=msg)
+    msg = 'Test result file to merge with the mergetests command'
+    optgrp.add_option('--merge-results', action='append', default=[],
+                      metavar='FILE', help=msg)
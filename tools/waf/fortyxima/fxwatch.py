@@ -0,0 +1,326 @@
+'''Continuous rebuilding and testing on source file changes.
+
+The build context is kept alive between the cycles, so that the node tree, the
+dependency information of the tasks and the module dependencies of the sources
+do not have to be reconstructed. After each change only the outdated tasks are
+rebuilt, and only those tests are rerun, whose modules depend (directly or
+indirectly) on the changed files.
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import re
+import select
+import struct
+from waflib import Errors, Logs
+
+# Fortran sources scanned for module dependencies
+FORTRAN_EXTS = ('.F90', '.f90')
+
+# Module dependencies of the tests are extracted by the fxunit scanner
+FXUNIT_SCANNER = 'tools/fxunit/fxunit.py'
+
+# Time (in s) to wait for further events after a change has been detected
+SETTLE_TIME = 0.1
+
+INCLUDE_PATTERN = re.compile(r'^\s*#:include\s*(["\'])(?P<incfile>.+?)\1',
+                             re.MULTILINE)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def watch(bld, dirnames, testdirnames):
+    '''Builds and tests continuously until interrupted.
+
+    :param bld: Build context.
+    :param dirnames: Directories (relative to the source directory) to watch.
+    :param testdirnames: Directories (relative to the source directory)
+        containing the sources of the test drivers.
+    '''
+    bld.restore()
+    if not bld.all_envs:
+        bld.load_envs()
+    try:
+        watcher = InotifyWatcher()
+    except OSError as exc:
+        bld.fatal('Can not watch source files (inotify not available): %s'
+                  % (exc, ))
+    dirs = [ bld.srcnode.find_dir(dirname).abspath() for dirname in dirnames ]
+    for dirname in dirs:
+        watcher.add_tree(dirname)
+    scanner = _load_scanner(bld.srcnode.find_node(FXUNIT_SCANNER).abspath())
+    testdirs = [ bld.srcnode.find_dir(dirname).abspath()
+                 for dirname in testdirnames ]
+    deps = ModuleDependencies(scanner, dirs, testdirs)
+
+    run_cycle(bld, None)
+    Logs.pprint('CYAN', 'Watching %s for changes (Ctrl-C to stop)'
+                % (', '.join(dirnames), ))
+    try:
+        while True:
+            changed = watcher.wait(SETTLE_TIME)
+            changed = [ fname for fname in changed if _is_relevant(fname) ]
+            if not changed:
+                continue
+            Logs.pprint('CYAN', '\nChanged: %s' % ', '.join(
+                [ os.path.relpath(fname, bld.srcnode.abspath())
+                  for fname in sorted(changed) ]))
+            tests = deps.update(changed)
+            forget_nodes(bld, changed)
+            run_cycle(bld, tests)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+def run_cycle(bld, tests):
+    '''Executes the build with all task generators created anew.
+
+    :param bld: Build context (kept between the cycles).
+    :param tests: Set of the tests to run or None for all of them.
+    '''
+    bld.groups = []
+    bld.group_names = {}
+    bld.current_group = 0
+    bld.task_gen_cache_names = {}
+    bld.recurse_cache = {}
+    bld.idx = {}
+    bld.pre_funs = []
+    bld.post_funs = []
+    bld.utest_results = []
+    bld.utest_durations = {}
+    bld.selected_tests = tests
+    try:
+        bld.execute_build()
+    except Errors.WafError as exc:
+        Logs.error(str(exc))
+    if tests is not None and not tests:
+        Logs.pprint('CYAN', 'No tests affected by the change.')
+
+
+def forget_nodes(bld, fnames):
+    '''Drops cached signatures of changed source files and deleted nodes.'''
+    for fname in fnames:
+        node = bld.root.find_node(fname)
+        if node is None:
+            continue
+        if not os.path.exists(fname):
+            try:
+                del node.parent.children[node.name]
+            except KeyError:
+                pass
+            continue
+        for attr in ('cache_sig', 'sig'):
+            try:
+                delattr(node, attr)
+            except AttributeError:
+                pass
+
+
+class ModuleDependencies(object):
+
+    '''Keeps track of which tests depend on which source files.'''
+
+    def __init__(self, scanner, dirs, testdirs):
+        self._scanner = scanner
+        # Only files in these directories are scanned for tests, as
+        # parameterless subroutines elsewhere would be taken for tests as well
+        self._testdirs = [ os.path.join(testdir, '') for testdir in testdirs ]
+        # file -> (defined modules, used modules, included files, tests)
+        self._files = {}
+        for dirname in dirs:
+            for root, subdirs, fnames in os.walk(dirname):
+                for fname in fnames:
+                    if fname.endswith(FORTRAN_EXTS):
+                        self._scan(os.path.join(root, fname))
+
+
+    def update(self, fnames):
+        '''Rescans changed files and returns the tests affected by them.
+
+        :param fnames: Absolute names of the changed files.
+        :return: Set with the names of the affected tests, or None if all tests
+            should be run (e.g. because a non-Fortran file or a test driver
+            without module has been changed).
+        '''
+        for fname in fnames:
+            if fname.endswith(FORTRAN_EXTS) and os.path.exists(fname):
+                self._scan(fname)
+            else:
+                self._files.pop(fname, None)
+        changed = set()
+        for fname in fnames:
+            includers = self._including_files(fname)
+            if fname not in self._files:
+                # Unknown dependencies of non-Fortran or deleted files
+                if len(includers) == 1:
+                    return None
+                includers.discard(fname)
+            changed.update(includers)
+        modules = set()
+        for fname in changed:
+            defined = self._files[fname][0]
+            if not defined:
+                return None
+            modules.update(defined)
+        affected = self._using_modules(modules)
+        tests = set()
+        for defined, used, included, testnames in self._files.values():
+            if defined & affected:
+                tests.update(testnames)
+        return tests
+
+
+    def _scan(self, fname):
+        fp = open(fname, 'r')
+        txt = fp.read()
+        fp.close()
+        scanner = self._scanner
+        defined = set([ mod[0] for mod in scanner.get_modules(txt) ])
+        used = scanner.get_used_modules(txt) - defined
+        included = set([ match.group('incfile')
+                         for match in INCLUDE_PATTERN.finditer(txt) ])
+        tests = set()
+        if fname.startswith(tuple(self._testdirs)):
+            tests.update([ scanner.get_test_name(modname, subname)
+                           for modname, typename, subname
+                           in scanner.get_test_method_calls(txt) ])
+        self._files[fname] = (defined, used, included, tests)
+
+
+    def _including_files(self, fname):
+        '''Returns the file and all files including it (transitively).'''
+        result = set([ fname ])
+        waiting = [ os.path.basename(fname) ]
+        processed = set()
+        while waiting:
+            incname = waiting.pop()
+            if incname in processed:
+                continue
+            processed.add(incname)
+            for other, (defined, used, included, tests) in self._files.items():
+                if incname in included and other not in result:
+                    result.add(other)
+                    waiting.append(os.path.basename(other))
+        return result
+
+
+    def _using_modules(self, modules):
+        '''Returns the modules and all modules using them (transitively).'''
+        result = set(modules)
+        size = 0
+        while size != len(result):
+            size = len(result)
+            for defined, used, included, tests in self._files.values():
+                if used & result:
+                    result.update(defined)
+        return result
+
+
+class InotifyWatcher(object):
+
+    '''Watches directory trees for changes using inotify.'''
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify_init1 not found')
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths = {}
+
+
+    def add_tree(self, dirname):
+        '''Watches a directory and all its subdirectories.'''
+        for root, subdirs, fnames in os.walk(dirname):
+            subdirs[:] = [ subdir for subdir in subdirs
+                           if not subdir.startswith('.') ]
+            self._add(root)
+
+
+    def wait(self, settle_time):
+        '''Waits for changes.
+
+        :param settle_time: Time to wait for further events after the first
+            one, in order to collect the changes of a save or checkout at once.
+        :return: Set with the absolute names of the changed files.
+        '''
+        changed = set()
+        timeout = None
+        while True:
+            readable = select.select([ self._fd ], [], [], timeout)[0]
+            if not readable:
+                return changed
+            changed.update(self._read_events())
+            timeout = settle_time
+
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+    def _add(self, dirname):
+        wd = self._libc.inotify_add_watch(self._fd, dirname.encode(),
+                                          WATCH_MASK)
+        if wd >= 0:
+            self._paths[wd] = dirname
+
+
+    def _read_events(self):
+        data = os.read(self._fd, 65536)
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, namelen = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + namelen].rstrip(b'\0')
+            if not isinstance(name, str):
+                name = name.decode()
+            pos += namelen
+            dirname = self._paths.get(wd)
+            if dirname is None or not name:
+                continue
+            fname = os.path.join(dirname, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(fname)
+                continue
+            changed.add(fname)
+        return changed
+
+
+def _is_relevant(fname):
+    '''Filters out hidden and backup files of editors.'''
+    basename = os.path.basename(fname)
+    return not (basename.startswith(('.', '#')) or basename.endswith('~'))
+
+
+def _load_scanner(fname):
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source('fxunit_scanner', fname)
+    spec = importlib.util.spec_from_file_location('fxunit_scanner', fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module